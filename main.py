@@ -1,19 +1,25 @@
 # -*- coding: utf-8 -*-
 import streamlit as st
-import whisper
-import tempfile
+from faster_whisper import BatchedInferencePipeline, WhisperModel
+import ctranslate2
+import av
+import numpy as np
+import xxhash
+from mutagen.mp3 import MP3
+import csv
 import io
 import os
-import gc
-import pandas as pd
+import re
+import threading
+from functools import partial
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 
 # =========================
 # セキュリティ強化ポイント
-# - モデルのみcache_resource（ユーザーデータはキャッシュしない）
-# - アップロード音声はBytesIOで扱い、必要最小限だけ一時ファイル化
-# - 一時ファイルは try/finally で確実に削除
+# - モデルのみcache_resource（ユーザーデータはキャッシュしない。書き起こし結果は本人のセッション内のみ保持）
+# - アップロード音声（UploadedFile=BytesIO）はコピーせずメモリ上でデコード（一時ファイルを作らない）
 # - 例外内容は詳細を出さずに短文化（データ露出防止）
-# - 拡張子/サイズ/MIMEを基本検証
+# - サイズ/ファイル先頭のマジックバイト（ID3・MPEGフレーム同期）を基本検証
 # - 文字列編集はtext_area（長文＆誤入力の誤送信を減らす）
 # =========================
 
@@ -24,111 +30,195 @@ import pandas as pd
 # [browser]
 # gatherUsageStats = false
 
-ALLOWED_EXT = {".mp3"}          # 必要なら .wav などを追加
 MAX_MB_EACH = 200                # 個別ファイル上限（MB）
-ALLOWED_MIME = {"audio/mpeg"}   # ブラウザが付けるMIME（参考）
+BATCH_SIZE = 16                  # 1ファイル内の30秒チャンクをまとめて推論する数
+SAMPLE_RATE = 16000              # Whisperの入力サンプリングレート
+MAX_WORKERS = 3                  # 同時に処理するファイル数（CPUでも次ファイルのデコードを推論と重ねる）
+# 推論スレッド数は物理コア相当に固定（過剰なスレッドはキャッシュ競合で逆に遅くなる）
+CPU_THREADS = max(1, (os.cpu_count() or 1) // 2)
+# CPUでは並列にしても同じコアを奪い合うだけなので、1本に全スレッドを使う
+NUM_WORKERS = MAX_WORKERS if ctranslate2.get_cuda_device_count() > 0 else 1
+PREVIEW_INTERVAL = 0.5           # 書き起こし途中経過の更新間隔（秒）
+
+# 言語ごとのモデル（表示名: (言語コード, モデル)）
+# 言語が分かっていれば軽量な蒸留モデルを使い、言語判定の処理も省く
+LANGUAGE_MODELS = {
+    "日本語": ("ja", "small"),
+    "English": ("en", "distil-small.en"),
+    "自動判定（多言語）": (None, "large-v3-turbo"),
+}
+_MODEL_BY_LANGUAGE = dict(LANGUAGE_MODELS.values())
+
+# 自動置換ルール（業務ルールに応じて調整）
+REPLACEMENTS = {"クラシャ": "コラショ"}
+# 全ルールを1本の正規表現にまとめ、1パスで置換（長い語を優先）
+# ルールが空のときは置換しない（空パターンは全位置に一致してしまうため）
+_REPLACE_PATTERN = re.compile(
+    "|".join(map(re.escape, sorted(REPLACEMENTS, key=len, reverse=True)))
+) if REPLACEMENTS else None
+
+def _replace_match(m: re.Match) -> str:
+    return REPLACEMENTS[m.group(0)]
 
 @st.cache_resource
-def load_model():
+def load_model(lang):
     # Whisperローカルモデル（外部送信なし）
-    return whisper.load_model("small")
+    # CTranslate2バックエンド＋int8量子化で CPU でも軽量・高速に動かす
+    # BatchedInferencePipelineで30秒チャンクをバッチ推論する
+    # num_workersでスレッドからの同時transcribeを実際に並列化する
+    whisper_model = WhisperModel(
+        _MODEL_BY_LANGUAGE[lang], device="auto", compute_type="int8",
+        cpu_threads=CPU_THREADS, num_workers=NUM_WORKERS,
+    )
+    # 1秒の無音で一度推論し、初回のカーネル初期化などをここで済ませておく
+    # （VADを通すと無音はスキップされるため、パイプラインを介さず直接実行）
+    segments, _info = whisper_model.transcribe(
+        np.zeros(SAMPLE_RATE, dtype=np.float32), language=lang, beam_size=1, vad_filter=False
+    )
+    for _segment in segments:
+        pass
+    # ウォームアップ後はジョブが来るまでCPUメモリへ退避（GPUを占有し続けない）
+    if whisper_model.model.device == "cuda":
+        whisper_model.model.unload_model(to_cpu=True)
+    return BatchedInferencePipeline(whisper_model)
+
+@st.cache_resource
+def _model_residency(lang) -> dict:
+    # 全セッション共有・モデルごと：未完了の推論ジョブ数（GPUから退避してよいかの判定用）
+    return {"lock": threading.Lock(), "jobs": 0}
+
+def _hold_model():
+    """
+    推論ジョブ1件分、モデルをGPUに載せておく。返り値はジョブ完了時に呼ぶ解放関数。
+    どのセッションにも未完了のジョブがなくなったらCPUメモリへ退避する（CPU実行時は何もしない）。
+    """
+    ct2_model = model.model.model
+    residency = _model_residency(language)
+    with residency["lock"]:
+        residency["jobs"] += 1
+        if not ct2_model.model_is_loaded:
+            ct2_model.load_model()
+
+    def release(_future=None):
+        with residency["lock"]:
+            residency["jobs"] -= 1
+            if residency["jobs"] == 0 and ct2_model.device == "cuda":
+                ct2_model.unload_model(to_cpu=True)
 
-model = load_model()
+    return release
 
 st.title("🎤 Whisper 音声書き起こしアプリ")
 
+language_label = st.sidebar.selectbox("音声の言語", list(LANGUAGE_MODELS))
+language = LANGUAGE_MODELS[language_label][0]
+model = load_model(language)
+
 uploaded_files = st.sidebar.file_uploader(
     "音声ファイルをアップロードしてください（mp3）",
     type=["mp3"],
     accept_multiple_files=True
 )
 
-# 書き起こし結果
-results = []
-
-def _safe_ext(name: str) -> str:
-    # 拡張子の簡易チェック用（小文字化）
-    return os.path.splitext(name or "")[1].lower()
+def _is_mp3(head: bytes) -> bool:
+    # 中身で判定（ID3タグ or MPEG Layer III のフレーム同期）。拡張子偽装も弾く
+    return head[:3] == b"ID3" or (len(head) >= 2 and head[0] == 0xFF and (head[1] & 0xE6) == 0xE2)
 
-def _bytesio_from_uploaded(file) -> io.BytesIO:
-    # UploadedFile → BytesIO（二度読み防止のため一括取得）
-    file.seek(0)
-    data = file.read()
-    return io.BytesIO(data)
+def _probe_duration(file) -> float:
+    # mp3ヘッダだけを読んで長さ（秒）を得る（全体はデコードしない）
+    try:
+        return MP3(file).info.length
+    except Exception:
+        return 0.0
+    finally:
+        file.seek(0)
 
-def transcribe_from_bytesio(bio: io.BytesIO, suffix=".mp3") -> str:
+def decode_audio_array(bio: io.BytesIO) -> np.ndarray:
     """
-    Whisperはファイルパス入力が安定。
-    一時ファイルを書いてFFmpeg→Whisper、終了後に削除。
+    PyAVでBytesIOを直接デコードし、16kHzモノラルfloat32配列にする。
+    一時ファイル書き出しとFFmpegプロセス起動を省く。
     """
-    tmp_path = None
-    try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-            tmp.write(bio.getbuffer())
-            tmp_path = tmp.name
-        result = model.transcribe(tmp_path)
-        text = result.get("text", "")
-        return text
-    finally:
-        # 一時ファイルは確実に削除
-        if tmp_path and os.path.exists(tmp_path):
+    resampler = av.AudioResampler(format="flt", layout="mono", rate=SAMPLE_RATE)
+    chunks = []
+    with av.open(bio, mode="r", metadata_errors="ignore") as container:
+        for packet in container.demux(audio=0):
             try:
-                os.remove(tmp_path)
-            except Exception:
-                pass
-
-if uploaded_files:
-    for file in uploaded_files:
-        # ---------- 入力検証 ----------
-        # サイズ検証
-        size_mb = (file.size or 0) / (1024 * 1024)
-        if size_mb > MAX_MB_EACH:
-            st.warning(f"❗ ファイルが大きすぎます（{size_mb:.1f}MB > {MAX_MB_EACH}MB）: {file.name}")
-            continue
+                frames = packet.decode()
+            except av.error.InvalidDataError:
+                # 末尾のゴミなど壊れたパケットは読み飛ばす（ffmpegコマンドと同じ挙動）
+                continue
+            for frame in frames:
+                for out in resampler.resample(frame):
+                    chunks.append(out.to_ndarray().ravel())
+    # リサンプラ内に残ったサンプルを吐き出す
+    for out in resampler.resample(None):
+        chunks.append(out.to_ndarray().ravel())
+    if not chunks:
+        return np.zeros(0, dtype=np.float32)
+    return np.concatenate(chunks)
 
-        # 拡張子検証
-        ext = _safe_ext(file.name)
-        if ext not in ALLOWED_EXT:
-            st.warning(f"❗ 未対応の拡張子です: {file.name}")
-            continue
+def _content_digest(file) -> str:
+    # アップロードバッファをコピーせずにハッシュ化（xxh3はデコードに比べ無視できる速さ）
+    with file.getbuffer() as view:
+        return xxhash.xxh3_128_hexdigest(view)
 
-        # MIME検証（参考：ブラウザ依存で厳密ではない）
-        if getattr(file, "type", None) and file.type not in ALLOWED_MIME:
-            # 厳しくしすぎると一部ブラウザで弾く可能性→警告に留める
-            st.info(f"ℹ️ 参考情報: このファイルのMIMEタイプは {file.type} です。再生に問題がなければ続行します。")
+def _store_transcript(tx_cache: dict, tx_pending: dict, tx_key, future: Future) -> None:
+    # 完了した書き起こしはその場でセッションに保存（再実行で中断されても結果を捨てない）
+    if not future.cancelled() and future.exception() is None:
+        tx_cache[tx_key] = future.result()
+    # 保存してから実行中の一覧から外す（再実行時はどちらかで必ず見つかる）
+    tx_pending.pop(tx_key, None)
 
-        # ---------- 再生表示用にBytesIOを確保 ----------
-        try:
-            audio_bytes = _bytesio_from_uploaded(file)
-        except Exception:
-            st.warning(f"❗ ファイル読み込みに失敗しました。破損していないかご確認ください: {file.name}")
-            continue
+def transcribe_from_bytesio(bio: io.BytesIO, parts: list = None) -> str:
+    """
+    メモリ上でデコードした波形をそのままWhisperへ渡す。
+    parts を渡すと確定したセグメントを順次追記する（途中経過表示用）。
+    """
+    samples = decode_audio_array(bio)
+    if parts is None:
+        parts = []
+    # segments は遅延評価のジェネレータ（確定した分から順に得られる）
+    segments, _info = model.transcribe(
+        samples, language=language, beam_size=1, vad_filter=True, batch_size=BATCH_SIZE
+    )
+    for segment in segments:
+        parts.append(segment.text)
+    return "".join(parts)
 
-        # 再生（BytesIOを渡す）
-        st.audio(audio_bytes, format="audio/mp3")
+def _results_to_csv(rows) -> bytes:
+    """
+    結果をCSV（UTF-8 BOM付き・Excel互換）のバイト列にする。
+    1行ずつバッファへ書き出し、全文の文字列コピーを作らない。
+    """
+    buf = io.BytesIO()
+    # BOMはutf-8-sigコーデックが先頭に1回だけ書く（文字列→バイト列の変換もここで1回のみ）
+    text_io = io.TextIOWrapper(buf, encoding="utf-8-sig", newline="", write_through=True)
+    writer = csv.writer(text_io)
+    writer.writerow(["ファイル名", "書き起こしテキスト"])
+    writer.writerows((r["ファイル名"], r["書き起こしテキスト"]) for r in rows)
+    # TextIOWrapperの破棄でbufが閉じられないよう切り離す
+    text_io.detach()
+    return buf.getvalue()
 
-        # ファイルメタ表示（内容は出さない）
-        st.write(f"ファイル名: {file.name}")
-        st.write(f"ファイルサイズ: {size_mb:.2f} MB")
+@st.fragment
+def render_results(transcripts):
+    """
+    text_area編集のたびにスクリプト全体（検証・デコード・推論）を
+    再実行しないよう、結果表示とCSV出力をフラグメントに閉じ込める。
+    """
+    # 書き起こし結果
+    results = []
 
-        # ---------- 文字起こし ----------
-        with st.spinner("文字起こし中です…"):
-            try:
-                # 変換用に再度BytesIO（位置リセット）
-                audio_bytes.seek(0)
-                text = transcribe_from_bytesio(audio_bytes, suffix=ext)
-            except Exception:
-                st.warning(f"❗ 書き起こしに失敗しました。音声形式やファイル状態をご確認ください: {file.name}")
-                continue
-            finally:
-                # メモリクリーンアップ
-                del audio_bytes
-                gc.collect()
+    for file, size_mb, text in transcripts:
+        # 区切り線＋ファイルメタ表示（内容は出さない）。要素数を減らすため1つのmarkdownにまとめる
+        st.markdown(f"---\n\n**{file.name}** — {size_mb:.2f} MB")
 
-        st.success("書き起こし完了！")
+        # 再生（UploadedFileはBytesIOなのでそのまま渡す）
+        st.audio(file, format="audio/mp3")
 
-        # 自動置換（業務ルールに応じて調整）
-        safe_text = (text or "").replace("クラシャ", "コラショ")
+        # 自動置換（ルールはREPLACEMENTSで管理）
+        safe_text = text or ""
+        if _REPLACE_PATTERN:
+            safe_text = _REPLACE_PATTERN.sub(_replace_match, safe_text)
 
         # 編集はtext_areaに（長文対応＆誤送信抑止）
         edited_text = st.text_area(
@@ -138,25 +228,119 @@ if uploaded_files:
         )
 
         results.append({"ファイル名": file.name, "書き起こしテキスト": edited_text})
-        st.markdown("---")
 
     # ---------- すべての結果をCSV化 ----------
     if results:
         try:
-            df = pd.DataFrame(results)
-            csv_data = df.to_csv(index=False, encoding="utf-8-sig")  # Excel互換
+            csv_bytes = _results_to_csv(results)  # Excel互換
             st.download_button(
                 label="📄 書き起こし結果を CSV でダウンロード",
-                data=csv_data.encode("utf-8-sig"),
+                data=csv_bytes,
                 file_name="transcriptions.csv",
                 mime="text/csv"
             )
         except Exception:
             st.warning("❗ 結果のエクスポートに失敗しました。もう一度お試しください。")
+
+if uploaded_files:
+    # ---------- 入力検証（先に全ファイルを検証してから書き起こす） ----------
+    validated = []
+    for file in uploaded_files:
+        # サイズ検証
+        size_mb = (file.size or 0) / (1024 * 1024)
+        if size_mb > MAX_MB_EACH:
+            st.warning(f"❗ ファイルが大きすぎます（{size_mb:.1f}MB > {MAX_MB_EACH}MB）: {file.name}")
+            continue
+
+        # 形式検証（拡張子・MIMEではなくファイル先頭のバイト列で判定）
+        head = file.read(4)
+        file.seek(0)
+        if not _is_mp3(head):
+            st.warning(f"❗ mp3として認識できないファイルです: {file.name}")
+            continue
+
+        validated.append((file, size_mb, _probe_duration(file)))
+
+    # ---------- 文字起こし（1つのモデルを共有し、スレッドで並列実行） ----------
+    # デコードとエンコーダ推論を重ね合わせる。Streamlit呼び出しはメインスレッドのみ。
+    transcripts = []
+    if validated:
+        # 進捗表示は1つのプレースホルダを書き換える（要素を追加しない）
+        status = st.empty()
+        status.info("文字起こし中です…")
+        # 書き起こし済みテキストをセッション内で（内容ハッシュ, 言語）ごとに保持
+        # （同じファイルの再アップロードや別名アップロードは再推論しない）
+        tx_cache = st.session_state.setdefault("tx", {})
+        # 実行中のジョブ（キー→(future, 途中経過)）。再実行で中断されても走り続けるので再投入しない
+        tx_pending = st.session_state.setdefault("tx_pending", {})
+        pool = ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(validated)))
+        try:
+            # 途中経過の表示枠はアップロード順に確保
+            previews = [st.empty() for _ in validated]
+            futures = [None] * len(validated)
+            # 並列に推論できるときは長いファイルから投入し、最後に長いファイルだけが残って待たされるのを防ぐ
+            # （推論が1本ずつなら総時間は変わらないので、上から順に結果が出るようアップロード順のまま）
+            order = range(len(validated))
+            if NUM_WORKERS > 1:
+                order = sorted(order, key=lambda i: validated[i][2], reverse=True)
+            for i in order:
+                file, size_mb, _duration = validated[i]
+                digest = _content_digest(file)
+                tx_key = (digest, language)
+                parts = []
+                preview = previews[i]
+                # 同じ内容を同時にアップロードした場合や、前回の実行で投入済みの場合はそのジョブを共有する
+                # （完了時は結果を保存してから一覧から外すので、実行中の一覧を先に見る）
+                if tx_key in tx_pending:
+                    future, parts = tx_pending[tx_key]
+                    futures[i] = (file, size_mb, tx_key, future, parts, preview)
+                    continue
+                if tx_key in tx_cache:
+                    future = Future()
+                    future.set_result(tx_cache[tx_key])
+                    futures[i] = (file, size_mb, tx_key, future, parts, preview)
+                    continue
+
+                # 変換用に位置リセット（コピーせずアップロードバッファを直接読む）
+                file.seek(0)
+                # 実際に推論するジョブがあるときだけモデルをGPUに載せる
+                release_model = _hold_model()
+                future = pool.submit(transcribe_from_bytesio, file, parts)
+                future.add_done_callback(release_model)
+                tx_pending[tx_key] = (future, parts)
+                future.add_done_callback(partial(_store_transcript, tx_cache, tx_pending, tx_key))
+                futures[i] = (file, size_mb, tx_key, future, parts, preview)
+
+            # 推論中は確定したセグメントから途中経過を表示（待ち時間の体感を短縮）
+            pending = {future for _file, _size_mb, _tx_key, future, _parts, _preview in futures}
+            shown = [0] * len(futures)
+            while pending:
+                _done, pending = wait(pending, timeout=PREVIEW_INTERVAL)
+                for i, (file, _size_mb, _tx_key, _future, parts, preview) in enumerate(futures):
+                    # セグメントが増えたときだけ再送する
+                    if len(parts) > shown[i]:
+                        shown[i] = len(parts)
+                        preview.text(f"{file.name}: {''.join(parts)}")
+
+            # 結果はアップロード順に受け取る（途中経過は編集欄に置き換える）
+            for file, size_mb, _tx_key, future, _parts, preview in futures:
+                preview.empty()
+                try:
+                    transcripts.append((file, size_mb, future.result()))
+                except Exception:
+                    st.warning(f"❗ 書き起こしに失敗しました。音声形式やファイル状態をご確認ください: {file.name}")
         finally:
-            # 大きなオブジェクトを解放
-            del results
-            gc.collect()
+            # 再実行（アップロード追加・言語変更など）で中断された場合も待ち行列を消化せず戻る
+            # （実行中のジョブは完走し、結果は完了コールバックでセッションに保存される）
+            pool.shutdown(wait=False, cancel_futures=True)
+        if transcripts:
+            status.success("書き起こし完了！")
+        else:
+            status.warning("❗ 書き起こしできたファイルがありません。")
+
+    # 書き起こし結果の表示・編集・CSV出力（編集時はこの部分だけ再実行）
+    if transcripts:
+        render_results(transcripts)
 else:
     st.info("サイドバーから音声ファイル（mp3）をアップロードしてください。")
 